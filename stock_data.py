@@ -2,78 +2,270 @@
 This module accesses nasdaq APIs to scrape stock data for analyzation
 
 Resources used:
-https://docs.python.org/3/library/urllib.request.html
+https://docs.python.org/3/library/http.client.html
+https://docs.python.org/3/library/socket.html#socket.getaddrinfo
+https://docs.python.org/3/library/ssl.html#ssl.create_default_context
 https://medium.com/@danielhalwell/a-comprehensive-guide-to-web-scraping-with-python-using-the-requests-library-3eaf2bb8dfd7
-https://docs.python.org/3/library/gzip.html
+https://docs.python.org/3/library/zlib.html#zlib.decompressobj
+https://github.com/ijl/orjson
+https://github.com/pycompression/python-isal
+https://github.com/pycompression/python-zlib-ng
 https://docs.python.org/3/library/datetime.html
-https://docs.python.org/3/library/statistics.html
+https://docs.python.org/3/library/hashlib.html
+https://docs.python.org/3/library/tempfile.html#tempfile.mkstemp
+https://docs.python.org/3/library/math.html#math.fsum
+https://docs.python.org/3/library/array.html
 https://www.geeksforgeeks.org/how-to-use-sys-argv-in-python/
 https://docs.python.org/3/library/functions.html#open
+https://docs.python.org/3/library/concurrent.futures.html
 '''
-from urllib.request import Request, urlopen
-from json import loads, dump
-from gzip import decompress
+from http.client import HTTPSConnection, HTTPResponse, HTTPException, RemoteDisconnected
+from socket import getaddrinfo, create_connection, SOCK_STREAM
+from ssl import create_default_context
+from threading import local, Lock
+from functools import cache
+from os import makedirs, replace, listdir, remove
+from os.path import join, expanduser, exists
+from tempfile import mkstemp
+from hashlib import sha1
 from datetime import date
-from statistics import mean, median
-from sys import argv
+from math import fsum
+from array import array
+from sys import argv, stdin
+from concurrent.futures import ThreadPoolExecutor
 
-def download_data(ticker: str) -> dict:
+try:
+    # orjson parses and writes json several times faster than the json module
+    from orjson import loads, dumps
+except ImportError:
+    from json import loads, dumps as _json_dumps
+
+    def dumps(obj) -> bytes:
+        '''Matches orjson by returning the json text as bytes'''
+        return _json_dumps(obj).encode()
+
+try:
+    # isal inflates with Intel's SIMD accelerated ISA-L library, which is a few times faster than zlib
+    from isal.isal_zlib import decompress, decompressobj, error as ZlibError
+except ImportError:
+    try:
+        # zlib-ng is the next best choice, with SIMD inflating and CRC32 checks
+        from zlib_ng.zlib_ng import decompress, decompressobj, error as ZlibError
+    except ImportError:
+        from zlib import decompress, decompressobj, error as ZlibError
+
+# The date range covers the past 5 years and is worked out once since it is the same for every ticker
+_today = date.today()
+TODATE = _today.isoformat()
+FROMDATE = _today.replace(year = _today.year-5).isoformat()
+
+# I found this URL by inspecting the page and looking through the Network tab for json files
+PATH_TEMPLATE = f"/api/quote/{{ticker}}/chart?assetclass=stocks&fromdate={FROMDATE}&todate={TODATE}"
+
+# Header to appear as a web browser, which is the same for every request
+HEADERS = {
+    "Host": "api.nasdaq.com",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip",
+    "Referer": "https://www.nasdaq.com/",
+    "Origin": "https://www.nasdaq.com",
+    "DNT": "1",
+    "Sec-GPC": "1",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-site",
+    "Priority": "u=0",
+    "TE": "trailers"
+}
+
+# Downloaded data is saved here so later runs on the same day can skip the download
+CACHE_DIR = join(expanduser("~"), ".cache", "stock_data")
+
+# Holds one open connection to nasdaq per thread so later requests skip the connection setup
+_connections = local()
+_dns_lock = Lock()
+
+# Shared by every connection since building a context loads the system's certificates, which takes a while
+_ssl_context = create_default_context()
+
+@cache
+def _resolve(host: str, port: int) -> tuple:
+    '''Looks up every address of a host, which are then remembered for the rest of the run'''
+    return tuple(info[4][:2] for info in getaddrinfo(host, port, type = SOCK_STREAM))
+
+
+class _NasdaqConnection(HTTPSConnection):
+    '''An HTTPS connection that opens its socket using the cached DNS lookup'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self._connect_cached
+
+    @staticmethod
+    def _connect_cached(address: tuple, timeout: float, source_address: tuple = None):
+        # The lock makes threads that connect at the same time wait for one lookup instead of each doing their own
+        with _dns_lock:
+            addresses = _resolve(*address)
+
+        # Tries each address in turn like socket.create_connection does, so IPv6 can fall back to IPv4 and a dead server is skipped
+        for address in addresses:
+            try:
+                return create_connection(address, timeout, source_address)
+            except OSError as error:
+                last_error = error
+        raise last_error
+
+
+def _request(path: str) -> HTTPResponse:
+    '''Sends a GET request to nasdaq over this thread's kept-alive connection'''
+    connection = getattr(_connections, "nasdaq", None)
+    if connection is None:
+        connection = _NasdaqConnection("api.nasdaq.com", timeout = 5, context = _ssl_context)
+        _connections.nasdaq = connection
+
+    try:
+        connection.request("GET", path, headers = HEADERS)
+        return connection.getresponse()
+    except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        # The server closed the idle connection, so the request is retried on a new one
+        connection.close()
+        connection.request("GET", path, headers = HEADERS)
+        return connection.getresponse()
+
+
+def _download(path: str) -> tuple:
     '''
-    This function scrapes nasdaq stock data using a header to appear as a web browser,
-    then decompresses the gzip data and converts the json data to a python dictionary
+    Requests the data from nasdaq and decompresses the gzip data as it arrives instead of after
+    the whole response is read, returning both the compressed and decompressed data
     '''
-    # Constructs the URL using the ticker symbol entered and the current date to get the past 5 years of data
-    # I found this URL by inspecting the page and looking through the Network tab for json files
-    today = date.today()
-    todate = today.isoformat()
-    today = today.replace(year = today.year-5)
-    url = f"https://api.nasdaq.com/api/quote/{ticker.upper()}/chart?assetclass=stocks&fromdate={today.isoformat()}&todate={todate}"
-
-    # Header to appear as a web browser
-    headers = {
-        "Host": "api.nasdaq.com",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
-        "Accept": "application/json, text/plain, */*",
-        "Accept-Language": "en-US,en;q=0.5",
-        "Accept-Encoding": "gzip, deflate, br, zstd",
-        "Referer": "https://www.nasdaq.com/",
-        "Origin": "https://www.nasdaq.com",
-        "DNT": "1",
-        "Sec-GPC": "1",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-site",
-        "Priority": "u=0",
-        "TE": "trailers"
-    }
-
-    # Requests the data from nasdaq
-    req = Request(url, headers = headers)
+    # The compressed and decompressed data each go straight into one growing buffer so neither is held in memory twice by joining chunks
+    compressed = bytearray()
+    data = bytearray()
     try:
-        data = urlopen(req, timeout = 5).read()
-    except:
+        response = _request(path)
+        if response.status == 200:
+            # A wbits value of 31 makes zlib expect and check the gzip header and trailer
+            inflater = decompressobj(wbits = 31)
+            while chunk := response.read(65536):
+                compressed += chunk
+                data += inflater.decompress(chunk)
+            data += inflater.flush()
+
+            # A body that stops before the gzip trailer was cut off, which zlib does not treat as an error on its own
+            if not inflater.eof:
+                raise ZlibError("The gzip data ended early")
+    except ZlibError:
+        _connections.nasdaq.close()
+        print("The data was not compressed with gzip or could not be decompressed")
+        return b"", b""
+    except (OSError, HTTPException):
+        # Drops the connection so the next request starts from a clean one
+        _connections.nasdaq.close()
         print("The server could not be reached")
-        return {}
+        return b"", b""
+
+    if response.status != 200:
+        _connections.nasdaq.close()
+        print("The server rejected the request")
+        return b"", b""
+
+    return compressed, data
+
 
-    # Decompresses the gzip compressed data
+def _read_cache(cache_file: str) -> bytes:
+    '''Returns the decompressed data saved in a cache file, or empty bytes if there is none'''
     try:
-        data = decompress(data)
-    except:
-        print("The data was not compressed with gzip or could not be decompressed")
+        # The whole file is already in memory, so it is inflated in one call without a streaming decompressor
+        with open(cache_file, "rb") as file:
+            return decompress(file.read(), wbits = 31)
+    except (OSError, ZlibError):
+        return b""
+
+
+@cache
+def _prepare_cache() -> None:
+    '''Creates the cache folder and removes files from earlier days, which is only needed once per run'''
+    # Finds files from earlier days, which are never read again since the date starts every file name
+    try:
+        makedirs(CACHE_DIR, exist_ok = True)
+        old_files = [file_name for file_name in listdir(CACHE_DIR) if not file_name.startswith(TODATE)]
+    except OSError:
+        return
+
+    for file_name in old_files:
+        try:
+            remove(join(CACHE_DIR, file_name))
+        except OSError:
+            pass
+
+
+def _write_cache(cache_file: str, compressed: bytes) -> None:
+    '''Saves the compressed data so later runs today can skip the download'''
+    # Writes to a temporary file first so a half written cache file is never read
+    temp_file = None
+    try:
+        handle, temp_file = mkstemp(prefix = TODATE, dir = CACHE_DIR)
+        with open(handle, "wb") as file:
+            file.write(compressed)
+        replace(temp_file, cache_file)
+    except OSError:
+        print("The data could not be saved to the cache")
+        if temp_file:
+            try:
+                remove(temp_file)
+            except OSError:
+                pass
+
+
+def download_data(ticker: str) -> dict:
+    '''
+    This function scrapes nasdaq stock data using a header to appear as a web browser,
+    then decompresses the gzip data and converts the json data to a python dictionary
+    '''
+    # Exits if the ticker has characters that cannot be sent in the URL, such as a pasted curly quote
+    if not ticker.isascii():
+        print("The ticker symbol is not valid")
         return {}
-    
-    # Converts the json data to a python dictionary and gets the data list
+
+    # Constructs the URL using the ticker symbol entered
+    path = PATH_TEMPLATE.format(ticker = ticker.upper())
+
+    # Reuses the data saved by an earlier run today instead of downloading it again
+    _prepare_cache()
+    cache_file = join(CACHE_DIR, f"{TODATE}_" + sha1(ticker.upper().encode()).hexdigest() + ".json.gz")
+    data = _read_cache(cache_file)
+    if data:
+        compressed = b""
+    else:
+        compressed, data = _download(path)
+        if not data:
+            return {}
+
+    # Converts the json data to a python dictionary and gets the closing prices
     try:
         data = loads(data)
         if data["status"]["rCode"] != 200:
             print("The ticker does not exist")
             return {}
         data = data["data"]
-    except:
+
+        # Keeps only the closing prices, packed into an array of floats so the dictionary for every day can be freed
+        data = {"symbol": data["symbol"], "closes": array("d", (day["y"] for day in data["chart"]))}
+    except (ValueError, KeyError, TypeError):
         print("The data format is not in json or there is no data")
         return {}
 
+    # Exits before caching if there are no closing prices, so an empty response is not reused all day
+    if not data["closes"]:
+        print("There are no closing prices for the ticker")
+        return {}
+
+    if compressed:
+        _write_cache(cache_file, compressed)
+
     return data
 
 
@@ -81,25 +273,29 @@ def process_data(data: dict) -> dict:
     '''Parses the stock data dictionary to find the min, max, mean, and median value'''
     
     # Exits if there is no data
-    if data == {}:
+    if not data:
         return {}
 
-    # Removes unnecessary data and sorts the closing prices
-    closing_prices = []
+    # Sorts the closing prices
     try:
-        for day in data["chart"]:
-            closing_prices.append(day["y"])
-        closing_prices.sort()
-    except:
+        closing_prices = sorted(data["closes"])
+    except (KeyError, TypeError):
         print("The data could not be parsed")
         return {}
     
+    # Reads the median straight from the sorted prices instead of sorting them again
+    middle = len(closing_prices) // 2
+    if len(closing_prices) % 2:
+        median = closing_prices[middle]
+    else:
+        median = (closing_prices[middle - 1] + closing_prices[middle]) / 2
+
     # Produces statistic results dictionary
     stats = {
         "min": closing_prices[0],
         "max": closing_prices[-1],
-        "avg": mean(closing_prices),
-        "median": median(closing_prices),
+        "avg": fsum(closing_prices) / len(closing_prices),
+        "median": median,
         "ticker": data["symbol"]
     }
     
@@ -110,69 +306,88 @@ def store_json(json_data: list) -> None:
     file = None
     file_name = ""
 
-    while not file and file_name.lower() != "cancel":
-        file_name = input("Enter a name for a storage file or \"cancel\" to quit: ")
+    # Treats the end of piped input as "cancel" since no file name can be read after it
+    try:
+        while not file and file_name.lower() != "cancel":
+            file_name = input("Enter a name for a storage file or \"cancel\" to quit: ")
         
-        if file_name.lower() != "cancel":
-            try:
+            if file_name.lower() != "cancel":
                 # Checks if the file name is already used to avoid overriting files
-                file = open(file_name, "r")
-                file.close()
-
-                # Prompts the user about overriting the file
-                response = input("A file with that name already exists.\nAre you sure you want to overwrite it (yes or no)? ").lower()
-                while response[0] != "y" and response[0] != "n":
-                    response = input("Your response was invalid.\nAre you sure you want to overwrite the file (yes or no)? ").lower()
-                
-                # If yes, overrites the file, otherwise, allows selecting a new name
-                if response[0] == "y":
+                overwrite = True
+                if exists(file_name):
+                    # Prompts the user about overriting the file
+                    response = input("A file with that name already exists.\nAre you sure you want to overwrite it (yes or no)? ").lower()
+                    while response[:1] != "y" and response[:1] != "n":
+                        response = input("Your response was invalid.\nAre you sure you want to overwrite the file (yes or no)? ").lower()
+
+                    # If yes, overrites the file, otherwise, allows selecting a new name
+                    overwrite = response[0] == "y"
+
+                if overwrite:
                     try:
-                        file = open(file_name, "w")
-                    except:
+                        file = open(file_name, "wb")
+                    except (OSError, ValueError):
                         print("The file could not be written to")
-                        file = None
-                else:
-                    file = None
-            
-            except:
-                # Creates a new file if the file name is not already used
-                try:
-                    file = open(file_name, "w")
-                except:
-                    print("The file could not be written to")
-                    file = None
+    except EOFError:
+        print()
 
     # Writes the json data to the file
     if file:
         try:
-            dump(json_data, file)
-        except:
+            file.write(dumps(json_data))
+        except (OSError, TypeError, ValueError):
             print("The json data could not be written to the file")
         file.close()
 
 
-stats_list = []
-
-# Handles ticker symbols as command line arguments
-if len(argv) > 1:
-    for ticker in argv[1:]:
-        stats = process_data(download_data(ticker))
-        if stats:
-            stats_list.append(stats)
-else:
-    # Handles ticker symbols during runtime
-    ticker = ""
-    while ticker != "STOP":
-        ticker = input("Enter a ticker symbol or \"stop\" to proceed: ").upper()
-        if ticker != "STOP":
-            stats = process_data(download_data(ticker))
-            if stats:
-                stats_list.append(stats)
-
-# Prints the data to the console
-print("\nData:")
-for stats in stats_list:
-    print(stats)
-print()
-
-store_json(stats_list)
+def main() -> None:
+    '''Collects ticker symbols, downloads and processes their data, then offers to store it'''
+    stats_list = []
+
+    # Sets up the cache before any threads start so they never do it at the same time
+    _prepare_cache()
+
+    # Handles ticker symbols as command line arguments
+    tickers = argv[1:]
+
+    # Handles ticker symbols piped in, one per line, by reading them all up to "stop" so they can be downloaded together
+    # Anything after "stop" is left for the storage file prompt
+    if not tickers and not stdin.isatty():
+        for line in stdin:
+            ticker = line.strip()
+            if ticker.upper() == "STOP":
+                break
+            if ticker:
+                tickers.append(ticker)
+
+    if tickers:
+        # Removes repeated ticker symbols so each one is only requested once
+        tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+
+        # Downloads every ticker at the same time since each download spends most of its time waiting on the server
+        # The default worker count is based on the number of CPUs, which does not matter for waiting on the network
+        with ThreadPoolExecutor(max_workers = min(32, len(tickers))) as executor:
+            for stats in map(process_data, executor.map(download_data, tickers)):
+                if stats:
+                    stats_list.append(stats)
+    elif stdin.isatty():
+        # Handles ticker symbols during runtime
+        ticker = ""
+        while ticker != "STOP":
+            ticker = input("Enter a ticker symbol or \"stop\" to proceed: ").upper()
+            if ticker != "STOP":
+                stats = process_data(download_data(ticker))
+                if stats:
+                    stats_list.append(stats)
+
+    # Prints the data to the console
+    print("\nData:")
+    for stats in stats_list:
+        print(stats)
+    print()
+
+    store_json(stats_list)
+
+
+if __name__ == "__main__":
+    main()